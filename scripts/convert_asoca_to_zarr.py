@@ -0,0 +1,58 @@
+import nrrd
+import zarr
+import numpy as np
+from tqdm import tqdm
+from mis.settings import ASOCA_PATH
+
+def convert_volume(src_path, dst_path, dtype):
+    """
+    Convert one NRRD volume to a slice-chunked Zarr array.
+
+    Args:
+        src_path (Path): Source .nrrd volume of shape (H, W, num_slices).
+        dst_path (Path): Destination .zarr array, stored as (num_slices, H, W).
+        dtype (np.dtype): Storage dtype (int16 for CTCA, uint8 for annotations).
+
+    Returns:
+        None: Writes the Zarr array to dst_path
+    """
+
+    data, _ = nrrd.read(str(src_path))
+    data = np.ascontiguousarray(data.transpose(2, 0, 1)).astype(dtype)
+
+    arr = zarr.open(
+        str(dst_path),
+        mode="w",
+        shape=data.shape,
+        chunks=(1,) + data.shape[1:],
+        dtype=dtype,
+        compressor=zarr.Blosc(cname="zstd", clevel=1)
+    )
+    arr[:] = data
+
+
+if __name__ == "__main__":
+    """
+    Convert the ASOCA corpus to per-patient Zarr stores under <ASOCA_PATH>/zarr,
+    chunked per slice so training reads decompress one slice instead of the
+    whole gzip volume. Blosc-zstd decompresses an order of magnitude faster
+    than the gzip used inside the NRRD files.
+
+    Args:
+        None: Reads from ASOCA_PATH
+
+    Returns:
+        None: Writes the Zarr stores, run once before training
+    """
+
+    for group in ["Normal", "Diseased"]:
+        for sub in ["CTCA", "Annotations"]:
+
+            src_dir = ASOCA_PATH / group / sub
+            dst_dir = ASOCA_PATH / "zarr" / group / sub
+            dst_dir.mkdir(parents=True, exist_ok=True)
+
+            dtype = np.int16 if sub == "CTCA" else np.uint8
+
+            for src_path in tqdm(sorted(src_dir.glob(f"{group}_*.nrrd")), desc=f"{group}/{sub}"):
+                convert_volume(src_path, dst_dir / f"{src_path.stem}.zarr", dtype)
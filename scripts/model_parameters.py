@@ -12,20 +12,22 @@ from mis.models import UNet2D, UNet2DNonLocal
 from mis.settings import DEVICE, ASOCA_PATH
 import time
 
-def get_model_unet2d(model_name):
+def get_model_unet2d(model_name, jit=True):
     """
     Get the UNet2D model from the specified directory.
 
     Args:
         model_name (str): The name of the model. Separates on "nonlocal" and "concat" to find the correct model.
+        jit (bool, optional): Whether to TorchScript the model and run optimize_for_inference on it.
+            Freezes the parameters into the graph, so disable when inspecting them. Defaults to True.
 
     Returns:
-        model (UNet2D or UNet2DNonLocal): The loaded UNet2D model.
+        model (UNet2D or UNet2DNonLocal or ScriptModule): The loaded UNet2D model.
     """
-    
+
     scripts_dir = Path.cwd()
     model_dir = scripts_dir / f"{model_name}" / "epoch2" / "model"      # Manually change to correct epoch (best epoch)
-    
+
     if "nonlocal" in model_name:
         if "concat" in model_name:
             model = UNet2DNonLocal(1, 1, skip_conn="concat").to(DEVICE)
@@ -34,6 +36,18 @@ def get_model_unet2d(model_name):
     else:
         model = UNet2D(1, 1).to(DEVICE)
     model.load_state_dict(torch.load(model_dir, map_location="cpu"))
+
+    if jit:
+        model.eval()
+        try:
+            scripted = torch.jit.script(model)
+        except RuntimeError:
+            # The optional skip-connection arguments trip up scripting, fall back to tracing
+            scripted = torch.jit.trace(model, torch.zeros(1, 1, 256, 256, device=DEVICE), check_trace=False)
+        model = torch.jit.optimize_for_inference(scripted)
+        # Warm-up so callers don't pay the JIT cost inside their timed loops
+        model(torch.zeros(1, 1, 256, 256, device=DEVICE))
+
     return model
 
 def get_model_segformer(model_name):
@@ -72,7 +86,7 @@ if __name__ == "__main__":
     
     for model_name in model_names:
         if "unet2d" in model_name:
-            model = get_model_unet2d(model_name)
+            model = get_model_unet2d(model_name, jit=False)
         if "segformer" in model_name:
             model = get_model_segformer(model_name)
         else:
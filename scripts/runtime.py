@@ -6,17 +6,68 @@ from tqdm import tqdm
 from pathlib import Path
 import nrrd
 import torch.nn.functional as F
-from torchvision.transforms import Resize
 from transformers import SegformerForSemanticSegmentation, SegformerConfig
 from mis.models import UNet2D, UNet2DNonLocal
 from mis.settings import DEVICE, ASOCA_PATH
 import time
 
+INFERENCE_BATCH_SIZE = 32
+
+def preprocess_volume(img):
+    """
+    Normalize and resize a full CTCA volume in one vectorized pass on the device.
+
+    The whole volume crosses host->device once; per-slice normalization and the
+    resize then run on batched tensors on the GPU.
+
+    Args:
+        img (np.ndarray): Volume of shape (H, W, num_slices).
+
+    Returns:
+        vol (torch.Tensor): Device tensor of shape (num_slices, 1, 256, 256), normalized per slice.
+    """
+
+    vol = torch.from_numpy(img.astype(np.float32)).to(DEVICE, non_blocking=True)
+    vol = vol.permute(2, 0, 1).unsqueeze(1)
+    vol -= vol.amin(dim=(2, 3), keepdim=True)
+    vol /= vol.abs().amax(dim=(2, 3), keepdim=True).clamp_min(1e-8)
+    vol = F.interpolate(vol, size=(256, 256), mode="bilinear", align_corners=False)
+    return vol
+
+def make_timer():
+    """
+    Build phase-timing helpers for the analysis loops.
+
+    On CUDA, mark() records an event on the stream so the loop never blocks;
+    deltas are resolved after one synchronize per patient. On CPU/MPS it falls
+    back to perf_counter.
+
+    Returns:
+        mark, elapsed, sync: mark() -> marker, elapsed(a, b) -> seconds, sync() -> None.
+    """
+
+    if DEVICE == "cuda":
+        def mark():
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            return event
+        def elapsed(a, b):
+            return a.elapsed_time(b) / 1000
+        sync = torch.cuda.synchronize
+    else:
+        mark = time.perf_counter
+        def elapsed(a, b):
+            return b - a
+        def sync():
+            pass
+
+    return mark, elapsed, sync
+
 def perform_runtime_analysis_unet(model_name, number_of_patients=3):
-    
+
     scripts_dir = Path.cwd()
     model_dir = scripts_dir / f"{model_name}" / "epoch2" / "model"   # Change to correct epoch (best epoch)
-    
+
     if "nonlocal" in model_name:
         if "concat" in model_name:
             model = UNet2DNonLocal(1, 1, skip_conn="concat").to(DEVICE)
@@ -25,6 +76,14 @@ def perform_runtime_analysis_unet(model_name, number_of_patients=3):
     else:
         model = UNet2D(1, 1).to(DEVICE)
     model.load_state_dict(torch.load(model_dir, map_location="cpu"))
+    model = model.to(memory_format=torch.channels_last)
+    model.eval()
+    model = torch.compile(model, mode="reduce-overhead", fullgraph=False)
+
+    # Warm-up pays the compile cost outside the timed loop. Shapes stay fixed
+    # at (INFERENCE_BATCH_SIZE, 1, 256, 256) afterwards to avoid recompilation.
+    with torch.inference_mode(), torch.autocast(device_type="cuda", dtype=torch.bfloat16, enabled=(DEVICE == "cuda")):
+        model(torch.zeros(INFERENCE_BATCH_SIZE, 1, 256, 256, device=DEVICE))
 
     normal_dir = ASOCA_PATH / "Normal" / "Testset_Normal"
     diseased_dir = ASOCA_PATH / "Diseased" / "Testset_Disease"      # Use this to test
@@ -33,7 +92,9 @@ def perform_runtime_analysis_unet(model_name, number_of_patients=3):
     runtimes_dir.mkdir(exist_ok=True)
     out_dir = runtimes_dir / f"{model_name}"
     out_dir.mkdir(exist_ok=True)
-    
+
+    mark, elapsed, sync = make_timer()
+
     loading_times = []
     data_preprocessing_times = []
     inference_times = []
@@ -41,57 +102,67 @@ def perform_runtime_analysis_unet(model_name, number_of_patients=3):
     total_times = []
 
     for i in range(10, 10 + number_of_patients):
-        
+
         total_time_t0 = time.time()
-        
+
         loading_time_t0 = time.time()
         img, _ = nrrd.read(diseased_dir / f"{i}.nrrd")
         loading_time_t1 = time.time()
 
         preds = np.zeros_like(img)
-        
-        data_preprocessing_times_slices = []
-        inference_times_slices = []
-        data_postprocessing_times_slices = []
-        
+
+        data_preprocessing_time_t0 = time.time()
+        vol = preprocess_volume(img).contiguous(memory_format=torch.channels_last)
+        sync()
+        data_preprocessing_time_t1 = time.time()
+
+        chunk_marks = []
+        preds_gpu = torch.empty((vol.shape[0], 1, preds.shape[0], preds.shape[1]), device=DEVICE)
+
         print(f"Predicting patient {i+1}...")
-        for slice_idx in tqdm(range(img.shape[-1])):
-            
-            data_preprocessing_time_slice_t0 = time.time()
-            ctca = img[:, :, slice_idx][None, :, :]
-            ctca = ctca - ctca.min()
-            ctca = ctca / np.abs(ctca).max()
-            ctca = Resize((256, 256))(torch.Tensor(ctca)).to(DEVICE)
-            data_preprocessing_time_slice_t1 = time.time()
-            
-            inference_time_slice_t0 = time.time()
-            preds_nt = model(ctca[None,:,:,:])[-1]
-            inference_time_slice_t1 = time.time()
-            
-            data_postprocessing_time_slice_t0 = time.time()
-            preds_nu = torch.where(preds_nt>=0.5, 1.0, 0.0)
-            preds_u = F.interpolate(preds_nu, scale_factor=2, mode="nearest")
-            preds[:,:,slice_idx] = preds_u.detach().cpu().numpy()
-            data_postprocessing_time_slice_t1 = time.time()
-            
-            data_preprocessing_times_slices.append(data_preprocessing_time_slice_t1 - data_preprocessing_time_slice_t0)
-            inference_times_slices.append(inference_time_slice_t1 - inference_time_slice_t0)
-            data_postprocessing_times_slices.append(data_postprocessing_time_slice_t1 - data_postprocessing_time_slice_t0)
+        with torch.inference_mode(), torch.autocast(device_type="cuda", dtype=torch.bfloat16, enabled=(DEVICE == "cuda")):
+            for chunk_start in tqdm(range(0, vol.shape[0], INFERENCE_BATCH_SIZE)):
+
+                chunk = vol[chunk_start:chunk_start+INFERENCE_BATCH_SIZE]
+                chunk_len = chunk.shape[0]
+                if chunk_len < INFERENCE_BATCH_SIZE:
+                    # Pad the ragged last chunk so the compiled graph only ever sees one shape
+                    chunk = torch.cat((chunk, chunk.new_zeros((INFERENCE_BATCH_SIZE - chunk_len,) + chunk.shape[1:])))
+
+                chunk_t0 = mark()
+                preds_nt = model(chunk)[-1]
+                chunk_t1 = mark()
+
+                preds_nu = (preds_nt[:chunk_len] >= 0.5).to(preds_nt.dtype)
+                preds_u = F.interpolate(preds_nu, scale_factor=2, mode="nearest")
+                preds_gpu[chunk_start:chunk_start+chunk_len] = preds_u
+                chunk_t2 = mark()
+
+                chunk_marks.append((chunk_t0, chunk_t1, chunk_t2))
+
+            sync()
+            inference_times_chunks = np.empty(len(chunk_marks))
+            data_postprocessing_times_chunks = np.empty(len(chunk_marks))
+            for j, (chunk_t0, chunk_t1, chunk_t2) in enumerate(chunk_marks):
+                inference_times_chunks[j] = elapsed(chunk_t0, chunk_t1)
+                data_postprocessing_times_chunks[j] = elapsed(chunk_t1, chunk_t2)
+
+            preds[:,:,:] = preds_gpu.squeeze(1).permute(1,2,0).cpu().numpy()
 
         total_time_t1 = time.time()
-        
+
         loading_times.append(loading_time_t1 - loading_time_t0)
-        data_preprocessing_times.append(sum(data_preprocessing_times_slices))
-        inference_times.append(sum(inference_times_slices))
-        data_postprocessing_times.append(sum(data_postprocessing_times_slices))
+        data_preprocessing_times.append(data_preprocessing_time_t1 - data_preprocessing_time_t0)
+        inference_times.append(float(inference_times_chunks.sum()))
+        data_postprocessing_times.append(float(data_postprocessing_times_chunks.sum()))
         total_times.append(total_time_t1 - total_time_t0)
-        
+
     loading_time = sum(loading_times) / len(loading_times)
     data_preprocessing_time = sum(data_preprocessing_times) / len(data_preprocessing_times)
     inference_time = sum(inference_times) / len(inference_times)
     data_postprocessing_time = sum(data_postprocessing_times) / len(data_postprocessing_times)
     total_time = sum(total_times) / len(total_times)
-    
+
     percent_loading_time = round(loading_time / total_time * 100, 2)
     percent_data_preprocessing_time = round(data_preprocessing_time / total_time * 100, 2)
     percent_inference_time = round(inference_time / total_time * 100, 2)
@@ -111,7 +182,7 @@ def perform_runtime_analysis_unet(model_name, number_of_patients=3):
         f.write(f"- Inference time: {inference_time} ({percent_inference_time}%)\n")
         f.write(f"- Data postprocessing time: {data_postprocessing_time} ({percent_data_postprocessing_time}%)\n")
         f.write(f"- Total time: {total_time}\n")
-    
+
 
 def perform_runtime_analysis_segformer(model_name, number_of_patients=3):
     """
@@ -120,16 +191,24 @@ def perform_runtime_analysis_segformer(model_name, number_of_patients=3):
     Args:
         model_name (str): Name of the model to analyze.
         number_of_patients (int, optional): Number of patients used when analyzing. Defaults to 3.
-    
+
     Returns:
         None: Prints inference times and saves them to a file
     """
-    
+
     scripts_dir = Path.cwd()
     model_dir = scripts_dir / f"{model_name}" / "model"
 
     model = SegformerForSemanticSegmentation.from_pretrained("nvidia/mit-b0", num_labels=1).to(DEVICE)
     model.load_state_dict(torch.load(model_dir, map_location="cpu"))
+    model.eval()
+    model = torch.compile(model, mode="reduce-overhead", fullgraph=False)
+
+    # Warm-up pays the compile cost outside the timed loop. Shapes and strides
+    # stay fixed afterwards to avoid recompilation, so expand to 3 channels
+    # exactly like the timed calls do (stride-0 channels, not contiguous).
+    with torch.inference_mode(), torch.autocast(device_type="cuda", dtype=torch.bfloat16, enabled=(DEVICE == "cuda")):
+        model(torch.zeros(INFERENCE_BATCH_SIZE, 1, 256, 256, device=DEVICE).expand(-1, 3, -1, -1))
 
     normal_dir = ASOCA_PATH / "Normal" / "Testset_Normal"
     diseased_dir = ASOCA_PATH / "Diseased" / "Testset_Disease"      # Use this to test
@@ -138,7 +217,9 @@ def perform_runtime_analysis_segformer(model_name, number_of_patients=3):
     runtimes_dir.mkdir(exist_ok=True)
     out_dir = runtimes_dir / f"{model_name}"
     out_dir.mkdir(exist_ok=True)
-    
+
+    mark, elapsed, sync = make_timer()
+
     loading_times = []
     data_preprocessing_times = []
     inference_times = []
@@ -146,56 +227,69 @@ def perform_runtime_analysis_segformer(model_name, number_of_patients=3):
     total_times = []
 
     for i in range(10, 10 + number_of_patients):
-        
+
         total_time_t0 = time.time()
-        
+
         loading_time_t0 = time.time()
         img, _ = nrrd.read(diseased_dir / f"{i}.nrrd")
         loading_time_t1 = time.time()
 
         preds = np.zeros_like(img)
-        
-        data_preprocessing_times_slices = []
-        inference_times_slices = []
-        data_postprocessing_times_slices = []
-        
+
+        data_preprocessing_time_t0 = time.time()
+        vol = preprocess_volume(img)
+        sync()
+        data_preprocessing_time_t1 = time.time()
+
+        chunk_marks = []
+        preds_gpu = torch.empty((vol.shape[0], 1, preds.shape[0], preds.shape[1]), device=DEVICE)
+
         print(f"Predicting patient {i+1}...")
-        for slice_idx in tqdm(range(img.shape[-1])):
-            
-            data_preprocessing_time_slice_t0 = time.time()
-            ctca = img[:, :, slice_idx][None, :, :]
-            ctca = ctca - ctca.min()
-            ctca = ctca / np.abs(ctca).max()
-            ctca = Resize((256, 256))(torch.Tensor(ctca)).to(DEVICE)
-            data_preprocessing_time_slice_t1 = time.time()
-            
-            inference_time_slice_t0 = time.time()
-            preds_nt = model(ctca[None,:,:,:].repeat(1,3,1,1))[-1]
-            inference_time_slice_t1 = time.time()
-            
-            data_postprocessing_time_slice_t0 = time.time()
-            preds_nu = torch.where(preds_nt>=0.5, 1.0, 0.0)
-            preds_u = F.interpolate(preds_nu, scale_factor=2, mode="nearest")
-            data_postprocessing_time_slice_t1 = time.time()
-            
-            data_preprocessing_times_slices.append(data_preprocessing_time_slice_t1 - data_preprocessing_time_slice_t0)
-            inference_times_slices.append(inference_time_slice_t1 - inference_time_slice_t0)
-            data_postprocessing_times_slices.append(data_postprocessing_time_slice_t1 - data_postprocessing_time_slice_t0)
+        with torch.inference_mode(), torch.autocast(device_type="cuda", dtype=torch.bfloat16, enabled=(DEVICE == "cuda")):
+            for chunk_start in tqdm(range(0, vol.shape[0], INFERENCE_BATCH_SIZE)):
+
+                chunk = vol[chunk_start:chunk_start+INFERENCE_BATCH_SIZE]
+                chunk_len = chunk.shape[0]
+                if chunk_len < INFERENCE_BATCH_SIZE:
+                    # Pad the ragged last chunk so the compiled graph only ever sees one shape
+                    chunk = torch.cat((chunk, chunk.new_zeros((INFERENCE_BATCH_SIZE - chunk_len,) + chunk.shape[1:])))
+
+                chunk_t0 = mark()
+                preds_nt = model(chunk.expand(-1,3,-1,-1))[-1]
+                chunk_t1 = mark()
+
+                preds_nu = (preds_nt[:chunk_len] >= 0.5).to(preds_nt.dtype)
+                # Segformer logits come out at 1/4 input resolution, upsample
+                # straight to the volume resolution
+                preds_u = F.interpolate(preds_nu, size=(preds.shape[0], preds.shape[1]), mode="nearest")
+                preds_gpu[chunk_start:chunk_start+chunk_len] = preds_u
+                chunk_t2 = mark()
+
+                chunk_marks.append((chunk_t0, chunk_t1, chunk_t2))
+
+            sync()
+            inference_times_chunks = np.empty(len(chunk_marks))
+            data_postprocessing_times_chunks = np.empty(len(chunk_marks))
+            for j, (chunk_t0, chunk_t1, chunk_t2) in enumerate(chunk_marks):
+                inference_times_chunks[j] = elapsed(chunk_t0, chunk_t1)
+                data_postprocessing_times_chunks[j] = elapsed(chunk_t1, chunk_t2)
+
+            preds[:,:,:] = preds_gpu.squeeze(1).permute(1,2,0).cpu().numpy()
 
         total_time_t1 = time.time()
-        
+
         loading_times.append(loading_time_t1 - loading_time_t0)
-        data_preprocessing_times.append(sum(data_preprocessing_times_slices))
-        inference_times.append(sum(inference_times_slices))
-        data_postprocessing_times.append(sum(data_postprocessing_times_slices))
+        data_preprocessing_times.append(data_preprocessing_time_t1 - data_preprocessing_time_t0)
+        inference_times.append(float(inference_times_chunks.sum()))
+        data_postprocessing_times.append(float(data_postprocessing_times_chunks.sum()))
         total_times.append(total_time_t1 - total_time_t0)
-        
+
     loading_time = sum(loading_times) / len(loading_times)
     data_preprocessing_time = sum(data_preprocessing_times) / len(data_preprocessing_times)
     inference_time = sum(inference_times) / len(inference_times)
     data_postprocessing_time = sum(data_postprocessing_times) / len(data_postprocessing_times)
     total_time = sum(total_times) / len(total_times)
-    
+
     percent_loading_time = round(loading_time / total_time * 100, 2)
     percent_data_preprocessing_time = round(data_preprocessing_time / total_time * 100, 2)
     percent_inference_time = round(inference_time / total_time * 100, 2)
@@ -221,19 +315,19 @@ def perform_runtime_analysis_segformer(model_name, number_of_patients=3):
 if __name__ == "__main__":
     """
     Perform runtime analysis on the models.
-    
+
     Args:
         None: Alter the model names and number of patients manually
-    
+
     Returns:
         None: Prints inference times and saves them to a file
     """
-    
+
     model_names = [
         # Input your model names here as strings
     ]
     number_of_patients = 2
-    
+
     for model in model_names:
         if "unet2d" in model:
             perform_runtime_analysis_unet(model, number_of_patients)
@@ -241,5 +335,5 @@ if __name__ == "__main__":
             perform_runtime_analysis_segformer(model, number_of_patients)
         else:
             ValueError("Model not recognized.")
-    
-    
+
+
@@ -1,3 +1,4 @@
+import os
 import torch
 import torch.nn as nn
 import numpy as np
@@ -7,11 +8,13 @@ import json
 import seaborn as sns
 import torch.utils
 import torch.utils.data
-from sklearn.metrics import precision_recall_fscore_support, accuracy_score
+import torch.distributed as dist
 from tqdm import tqdm
 from pprint import pprint
 from pathlib import Path
-from torch.utils.data import Dataset, DataLoader
+from torch.nn.parallel import DistributedDataParallel as DDP
+from torch.utils.data import Dataset, DataLoader, DistributedSampler
+from torchvision.utils import make_grid, save_image
 from mis.models import UNet2D, UNet2DNonLocal
 from mis.datasets import ASOCADataset, BratsDataset
 from mis.settings import DEVICE, ASOCA_PATH
@@ -31,12 +34,40 @@ def train(
         out_dir: Path = Path("./training_results")
     ):
 
-    print(f"lr={args.lr}\nnum_epochs={args.num_epochs}\nbatch_size={args.batch_size}")
+    distributed = dist.is_available() and dist.is_initialized()
+    rank = dist.get_rank() if distributed else 0
+    device = f"cuda:{os.environ['LOCAL_RANK']}" if distributed else DEVICE
+    use_cuda = str(device).startswith("cuda")
 
-    model = model.to(DEVICE)
-    optimizer = torch.optim.AdamW(model.parameters(), lr=args.lr, weight_decay=0.99)
-    train_dl = DataLoader(train_data, batch_size=args.batch_size, shuffle=True)
-    validation_dl = DataLoader(validation_data, batch_size=args.batch_size)
+    if rank == 0:
+        print(f"lr={args.lr}\nnum_epochs={args.num_epochs}\nbatch_size={args.batch_size}")
+
+    model = model.to(device, memory_format=torch.channels_last)
+    if distributed:
+        model = DDP(model, device_ids=[int(os.environ["LOCAL_RANK"])])
+
+    optimizer = torch.optim.AdamW(model.parameters(), lr=args.lr, weight_decay=0.99, fused=use_cuda)
+    train_sampler = DistributedSampler(train_data) if distributed else None
+    validation_sampler = DistributedSampler(validation_data, shuffle=False) if distributed else None
+    train_dl = DataLoader(
+        train_data,
+        batch_size=args.batch_size,
+        shuffle=train_sampler is None,
+        sampler=train_sampler,
+        num_workers=args.workers,
+        pin_memory=True,
+        persistent_workers=args.workers > 0,
+        prefetch_factor=4 if args.workers > 0 else None
+    )
+    validation_dl = DataLoader(
+        validation_data,
+        batch_size=args.batch_size,
+        sampler=validation_sampler,
+        num_workers=args.workers,
+        pin_memory=True,
+        persistent_workers=args.workers > 0,
+        prefetch_factor=4 if args.workers > 0 else None
+    )
     min_loss = float("inf")
     loss_fn = dice_loss if args.loss == "dice" else gdlv_loss if args.loss=="gdlv" else focal_loss
     train_losses, val_losses = [], []
@@ -44,57 +75,90 @@ def train(
 
     for epoch in range(args.num_epochs):
 
-        print(f"STARTING EPOCH {epoch+1}")
+        if rank == 0:
+            print(f"STARTING EPOCH {epoch+1}")
+        if train_sampler is not None:
+            train_sampler.set_epoch(epoch)
         train_loss, train_dice = 0, 0
-        total_imgs, total_preds, total_masks = [], [], []
         model.train()
 
         pbar = tqdm(train_dl)
         for i, batch in enumerate(pbar):
 
-            images = batch["image"].to(DEVICE)
-            masks = batch["mask"].to(DEVICE)
-            _, probs = model(images)
+            images = batch["image"].to(device, non_blocking=True, memory_format=torch.channels_last)
+            masks = batch["mask"].to(device, non_blocking=True)
+
+            with torch.autocast(device_type="cuda", dtype=torch.bfloat16, enabled=use_cuda):
+                _, probs = model(images)
+
+            # Losses stay in fp32 (binary_cross_entropy is unsupported under autocast)
+            probs = probs.float()
             loss = loss_fn(masks, probs)
 
-            optimizer.zero_grad()
+            optimizer.zero_grad(set_to_none=True)
             loss.backward()
             optimizer.step()
-            train_loss += loss.item()
-            train_dice += 1 - dice_loss(masks, probs).item()
+            loss_val = loss.item()
+            train_loss += loss_val
+            # When training on dice the loss already is 1 - dice, no need to recompute
+            train_dice += 1 - (loss_val if args.loss == "dice" else dice_loss(masks, probs).item())
             
             if i % 10 == 0:
                 pbar.set_description(f"(Loss, Dice) step {i} = ({train_loss / (i+1)}, {train_dice / (i+1)})")
 
-        print("RUNNING VALIDATION")
+        if rank == 0:
+            print("RUNNING VALIDATION")
         model.eval()
         val_loss, val_dice  = 0, 0
+
+        # Indices of the samples plotted on a new best epoch, sampled up front
+        # so only those stay in memory instead of the whole validation set
+        num_val = len(validation_data)
+        plot_idx = set(np.random.choice(num_val, min(50, num_val), replace=False).tolist())
+        plot_imgs, plot_masks, plot_preds = [], [], []
+        seen = 0
+
+        # Streaming 2x2 confusion matrix, accumulated on device
+        tp = torch.zeros((), dtype=torch.long, device=device)
+        fp = torch.zeros((), dtype=torch.long, device=device)
+        fn = torch.zeros((), dtype=torch.long, device=device)
+        tn = torch.zeros((), dtype=torch.long, device=device)
+
         with torch.no_grad():
             pbar = tqdm(validation_dl)
             for i, batch in enumerate(pbar):
 
-                images = batch["image"].to(DEVICE)
-                masks = batch["mask"].to(DEVICE)
+                images = batch["image"].to(device, non_blocking=True, memory_format=torch.channels_last)
+                masks = batch["mask"].to(device, non_blocking=True)
                 _, probs = model(images)
                 loss = loss_fn(masks, probs)
-                val_loss += loss.item()
-                val_dice += 1 - dice_loss(masks, probs).item()
-
-                preds = torch.where(probs >= 0.5, 1.0, 0.0) if args.thresh else probs
-
-                total_imgs += images.detach().cpu().tolist()
-                total_preds += preds.detach().cpu().tolist()
-                total_masks += masks.detach().cpu().tolist()
+                loss_val = loss.item()
+                val_loss += loss_val
+                val_dice += 1 - (loss_val if args.loss == "dice" else dice_loss(masks, probs).item())
+
+                preds = (probs >= 0.5).to(probs.dtype) if args.thresh else probs
+
+                if args.thresh:
+                    p = preds.bool()
+                    m = masks.bool()
+                    tp += (p & m).sum()
+                    fp += (p & ~m).sum()
+                    fn += (~p & m).sum()
+                    tn += (~p & ~m).sum()
+
+                for j in range(images.shape[0]):
+                    if seen + j in plot_idx:
+                        plot_imgs.append(images[j].detach().cpu())
+                        plot_masks.append(masks[j].detach().cpu())
+                        plot_preds.append(preds[j].detach().cpu())
+                seen += images.shape[0]
 
                 if i % 10 == 0:
                     pbar.set_description(f"(Loss, Dice) step {i} = ({val_loss / (i+1)}, {val_dice / (i+1)})")
 
-        total_masks_np = np.asarray(total_masks)
-        total_preds_np = np.asarray(total_preds)
-
-        if args.thresh:
-            a = accuracy_score(total_masks_np.flatten(), total_preds_np.flatten())
-            p, r, f, s = precision_recall_fscore_support(total_masks_np.flatten(), total_preds_np.flatten())
+        if distributed and args.thresh:
+            for t in (tp, fp, fn, tn):
+                dist.all_reduce(t)
 
         train_loss = train_loss / len(train_dl)
         val_loss = val_loss / len(validation_dl)
@@ -109,51 +173,46 @@ def train(
         }
 
         if args.thresh:
-            a = accuracy_score(total_masks_np.flatten(), total_preds_np.flatten())
-            p, r, f, s = precision_recall_fscore_support(total_masks_np.flatten(), total_preds_np.flatten())
-            metrics["accuracy"] = a
-            metrics["precision"] = p.tolist()
-            metrics["recall"] = r.tolist()
-            metrics["f1"] = f.tolist()
-            metrics["support"] = s.tolist()
+            tp_, fp_, fn_, tn_ = tp.item(), fp.item(), fn.item(), tn.item()
+            precision = tp_ / (tp_ + fp_) if tp_ + fp_ else 0.0
+            recall = tp_ / (tp_ + fn_) if tp_ + fn_ else 0.0
+            metrics["accuracy"] = (tp_ + tn_) / (tp_ + fp_ + fn_ + tn_)
+            metrics["precision"] = precision
+            metrics["recall"] = recall
+            metrics["f1"] = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+            metrics["support"] = tp_ + fn_
 
         train_losses.append(train_loss)
         val_losses.append(val_loss)
         train_dices.append(train_dice)
         val_dices.append(val_dice)
 
-        if val_loss < min_loss:
+        if rank == 0 and val_loss < min_loss:
             print("New min loss, saving model...")
             min_loss = val_loss
 
             epoch_dir = out_dir / f"epoch{epoch+1}"
             epoch_dir.mkdir(exist_ok=True)
 
-            torch.save(model.state_dict(), epoch_dir / "model")
+            torch.save((model.module if distributed else model).state_dict(), epoch_dir / "model")
   
             with open(epoch_dir / "metrics.json", "w") as f:
                 json.dump(metrics, f)
 
-            total_imgs_np = np.asarray(total_imgs)
-            rand_idx = np.random.choice(len(total_preds), 50, replace=False)
-
-            for idx in rand_idx:
-                _, ax = plt.subplots(ncols=3)
-                img = total_imgs_np[idx]
-                mask = total_masks_np[idx]
-                pred = total_preds_np[idx]
+            # One row per sample: image | ground truth | prediction
+            triplets = torch.stack([
+                torch.stack(plot_imgs),
+                torch.stack(plot_masks),
+                torch.stack(plot_preds),
+            ], dim=1).flatten(0, 1)
 
-                ax[0].imshow(img.squeeze())
-                ax[0].set_title("Image")
-                ax[1].imshow(mask.squeeze())
-                ax[1].set_title("Ground Truth")
-                ax[2].imshow(pred.squeeze())
-                ax[2].set_title("Prediction")
+            save_image(make_grid(triplets, nrow=3), epoch_dir / "preds.png")
 
-                plt.savefig(epoch_dir / f"pred{idx}")
-                plt.close()
+        if rank == 0:
+            pprint(metrics)
 
-        pprint(metrics)
+    if rank != 0:
+        return
 
     plt.title("Loss Per Epoch")
     plt.xlabel("Epoch")
@@ -182,6 +241,7 @@ if __name__ == "__main__":
         --lr: Learning rate for the optimizer
         --batch_size: Batch size for training
         --num_epochs: Number of epochs to train for
+        --workers: Number of DataLoader worker processes
         --loss: Loss function to use. Must be one of "dice", "focal", or "gdlv"
         --dataset: Dataset to use. Must be one of "asoca" or "brats"
         --skip_conn: Skip connection type to use. Must be one of "concat" or "add"
@@ -198,6 +258,7 @@ if __name__ == "__main__":
     parser.add_argument("--lr", default=1e-04, type=float)
     parser.add_argument("--batch_size", default=8, type=int)
     parser.add_argument("--num_epochs", default=3, type=int)
+    parser.add_argument("--workers", default=os.cpu_count() // 2, type=int)
     parser.add_argument("--loss", default="dice", type=str)
     parser.add_argument("--dataset", default="asoca", type=str)
     parser.add_argument("--skip_conn", default="concat", type=str)
@@ -208,6 +269,10 @@ if __name__ == "__main__":
 
     args = parser.parse_args()
 
+    # Launched via torchrun --nproc_per_node=N for multi-GPU training
+    if "WORLD_SIZE" in os.environ and int(os.environ["WORLD_SIZE"]) > 1:
+        dist.init_process_group("nccl")
+
     losses = ["dice", "focal", "gdlv"]
     if args.loss not in losses:
         raise ValueError(f"Loss must be in {losses}")
@@ -281,3 +346,6 @@ if __name__ == "__main__":
         args,
         out_dir=out_dir
     )
+
+    if dist.is_available() and dist.is_initialized():
+        dist.destroy_process_group()
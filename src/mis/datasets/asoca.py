@@ -1,11 +1,19 @@
+import os
 import torch
 import nrrd
+import json
 import numpy as np
+import torch.nn.functional as F
 from torch.utils.data import Dataset
-from torchvision.transforms import Resize
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from ..settings import ASOCA_PATH
 
+try:
+    import zarr
+except ImportError:
+    zarr = None
+
 np.random.seed(0)
 
 class ASOCADataset(Dataset):
@@ -20,7 +28,8 @@ class ASOCADataset(Dataset):
             norm: bool = True,
             thresh: bool = True,
             data_dir: Path = ASOCA_PATH,
-            split_strat: str = "random"
+            split_strat: str = "random",
+            use_mmap_cache: bool = False
         ):
         super().__init__()
 
@@ -54,45 +63,132 @@ class ASOCADataset(Dataset):
         if self.split_strat == "patientwise":
             self.trih, self.trid, self.vih, self.vid, self.tih, self.tid = self.get_patient_idx()
 
+        self._cache_path = data_dir / ".asoca_slice_cache.json"
+
         self.num_slices, self.healthy_indices, self.diseased_indices = self.get_num_slices()
         self.slice_cumsums = np.asarray(self.num_slices).cumsum()
+        self.ctca_paths, self.anno_paths = self.get_patient_paths()
+        self.ctca_zarrs, self.anno_zarrs = self.get_zarr_stores()
+        self._cached_patient_idx = None
+        self._cached_volumes = None
+
+        self.use_mmap_cache = use_mmap_cache
+        mmap_tag = f"{split_strat}_{split}_{size}{'_norm' if norm else ''}{'_t' if thresh else ''}"
+        self._mmap_img_path = data_dir / f".asoca_mmap_{mmap_tag}.img"
+        self._mmap_mask_path = data_dir / f".asoca_mmap_{mmap_tag}.mask"
+        self._mmap_meta_path = data_dir / f".asoca_mmap_{mmap_tag}.json"
+        self.img_mm, self.mask_mm = None, None
+
+        if use_mmap_cache:
+            if not to_torch:
+                raise ValueError("use_mmap_cache requires to_torch=True")
+            if not self._mmap_cache_valid():
+                self.build_mmap_cache()
+            shape = (len(self), 1, self.size, self.size)
+            self.img_mm = np.memmap(self._mmap_img_path, dtype=np.float16, mode="r", shape=shape)
+            self.mask_mm = np.memmap(self._mmap_mask_path, dtype=np.uint8, mode="r", shape=shape)
 
     def __len__(self):
         return sum(self.num_slices)
 
     def __getitem__(self, index):
 
-        patient_idx = np.argwhere(self.slice_cumsums>index)[0,0]
-        slice_idx = index % self.num_slices[patient_idx]
-
-        if patient_idx < len(self.healthy_indices):
-            ctca_path = self.n_path / "CTCA" /f"Normal_{self.healthy_indices[patient_idx]}.nrrd"
-            anno_path = self.n_path / "Annotations" / f"Normal_{self.healthy_indices[patient_idx]}.nrrd"
+        if self.img_mm is not None:
+            ctca = torch.from_numpy(self.img_mm[index].astype(np.float32))
+            anno = torch.from_numpy(self.mask_mm[index].astype(np.float32))
+            if self.thresh:
+                anno = torch.where(anno > 0.0, 1.0, 0.0)
         else:
-            patient_idx -= len(self.healthy_indices)
-            ctca_path = self.d_path / "CTCA" / f"Diseased_{self.diseased_indices[patient_idx]}.nrrd"
-            anno_path = self.d_path / "Annotations" / f"Diseased_{self.diseased_indices[patient_idx]}.nrrd"
+            ctca, anno = self._load_slice(index)
+
+        return {
+            "image": ctca,
+            "mask": anno
+        }
 
-        ctca, _ = nrrd.read(ctca_path)
-        ctca = ctca[:,:,slice_idx][None, :, :]
-        anno, _ = nrrd.read(anno_path)
-        anno = anno[:,:,slice_idx][None, :, :]
+    def _load_slice(self, index):
+
+        patient_idx = int(np.searchsorted(self.slice_cumsums, index, side="right"))
+        slice_idx = index - (self.slice_cumsums[patient_idx-1] if patient_idx else 0)
+
+        if self.ctca_zarrs is not None:
+            ctca = np.asarray(self.ctca_zarrs[patient_idx][slice_idx])[None, :, :]
+            anno = np.asarray(self.anno_zarrs[patient_idx][slice_idx])[None, :, :]
+        else:
+            ctca_vol, anno_vol = self._load_patient(int(patient_idx))
+            ctca = ctca_vol[:,:,slice_idx][None, :, :]
+            anno = anno_vol[:,:,slice_idx][None, :, :]
 
         if self.norm:
             ctca = ctca - ctca.min()
             ctca = ctca / np.abs(ctca).max()
 
         if self.to_torch:
-            ctca = Resize((self.size, self.size))(torch.Tensor(ctca))
-            anno = Resize((self.size, self.size))(torch.Tensor(anno))
+            ctca = torch.from_numpy(np.ascontiguousarray(ctca)).unsqueeze(0).float()
+            ctca = F.interpolate(ctca, size=(self.size, self.size), mode="bilinear", align_corners=False).squeeze(0)
+            anno = torch.from_numpy(np.ascontiguousarray(anno)).unsqueeze(0).float()
+            anno = F.interpolate(anno, size=(self.size, self.size), mode="nearest").squeeze(0)
             if self.thresh:
                 anno = torch.where(anno > 0.0, 1.0, 0.0)
 
+        return ctca, anno
+
+    def _mmap_fingerprint(self):
+
         return {
-            "image": ctca,
-            "mask": anno
+            "paths": [str(p) for p in self.ctca_paths],
+            "mtimes": [p.stat().st_mtime for p in self.ctca_paths],
+            "num_slices": list(self.num_slices)
         }
-    
+
+    def _mmap_cache_valid(self):
+
+        if not (self._mmap_img_path.exists() and self._mmap_mask_path.exists() and self._mmap_meta_path.exists()):
+            return False
+
+        with open(self._mmap_meta_path) as f:
+            meta = json.load(f)
+
+        # The index -> patient mapping depends on the selected corpus, so a
+        # stale cache built for a different patient set must be rebuilt
+        return meta == self._mmap_fingerprint()
+
+    def build_mmap_cache(self):
+
+        shape = (len(self), 1, self.size, self.size)
+        img_mm = np.memmap(self._mmap_img_path, dtype=np.float16, mode="w+", shape=shape)
+        mask_mm = np.memmap(self._mmap_mask_path, dtype=np.uint8, mode="w+", shape=shape)
+
+        for index in range(len(self)):
+            ctca, anno = self._load_slice(index)
+            img_mm[index] = ctca.numpy().astype(np.float16)
+            mask_mm[index] = (anno.numpy() > 0.0).astype(np.uint8)
+
+        img_mm.flush()
+        mask_mm.flush()
+
+        # Write-then-rename as for the slice-count cache; the meta file lands
+        # last so a crashed build never leaves a valid-looking cache behind
+        tmp_path = self._mmap_meta_path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self._mmap_fingerprint(), f)
+        os.replace(tmp_path, self._mmap_meta_path)
+
+    def _load_patient(self, patient_idx):
+        """
+        Return the decoded (ctca, anno) volumes for a patient, keeping the most
+        recently decoded pair per instance. Only pays off when slices of the
+        same patient are accessed sequentially; shuffled access decodes per call.
+        """
+
+        if self._cached_patient_idx != patient_idx:
+            ctca, _ = nrrd.read(self.ctca_paths[patient_idx])
+            anno, _ = nrrd.read(self.anno_paths[patient_idx])
+            self._cached_patient_idx = patient_idx
+            self._cached_volumes = (ctca, anno)
+
+        return self._cached_volumes
+
     def get_patient_idx(self):
 
         if self.merge_test_validation:   
@@ -114,15 +210,44 @@ class ASOCADataset(Dataset):
         return train_idx_healthy, train_idx_diseased, val_idx_healthy, val_idx_diseased, test_idx_healthy, test_idx_diseased
 
 
-    def get_num_slices(self):
+    def get_patient_paths(self):
+
+        ctca_paths, anno_paths = [], []
+
+        for i in self.healthy_indices:
+            ctca_paths.append(self.n_path / "CTCA" / f"Normal_{i}.nrrd")
+            anno_paths.append(self.n_path / "Annotations" / f"Normal_{i}.nrrd")
+
+        for i in self.diseased_indices:
+            ctca_paths.append(self.d_path / "CTCA" / f"Diseased_{i}.nrrd")
+            anno_paths.append(self.d_path / "Annotations" / f"Diseased_{i}.nrrd")
 
-        num_slices = []
-        healthy_indices = []
-        diseased_indices = []
+        return ctca_paths, anno_paths
+
+    def get_zarr_stores(self):
+
+        zarr_dir = self.data_dir / "zarr"
+        if zarr is None or not zarr_dir.exists():
+            return None, None
+
+        ctca_zarrs, anno_zarrs = [], []
+
+        for ctca_path, anno_path in zip(self.ctca_paths, self.anno_paths):
+            ctca_zarr = zarr_dir / ctca_path.relative_to(self.data_dir).with_suffix(".zarr")
+            anno_zarr = zarr_dir / anno_path.relative_to(self.data_dir).with_suffix(".zarr")
+            if not (ctca_zarr.exists() and anno_zarr.exists()):
+                # Incomplete conversion, fall back to reading the NRRD files
+                return None, None
+            ctca_zarrs.append(zarr.open(str(ctca_zarr), mode="r"))
+            anno_zarrs.append(zarr.open(str(anno_zarr), mode="r"))
+
+        return ctca_zarrs, anno_zarrs
+
+    def get_num_slices(self):
 
         if self.split_strat == "random":
-            normal_idx = range(1,self.num_normal+1)
-            diseased_idx = range(1,self.num_diseased+1)
+            normal_idx = list(range(1,self.num_normal+1))
+            diseased_idx = list(range(1,self.num_diseased+1))
         else:
             if self.split == "train":
                 normal_idx = self.trih
@@ -134,14 +259,34 @@ class ASOCADataset(Dataset):
                 normal_idx = self.tih
                 diseased_idx = self.tid
 
-        for i in normal_idx:
-            data, _ = nrrd.read(self.n_path / "CTCA" / f"Normal_{i}.nrrd")
-            num_slices.append(data.shape[-1])
-            healthy_indices.append(i)
+        ctca_paths = [self.n_path / "CTCA" / f"Normal_{i}.nrrd" for i in normal_idx]
+        ctca_paths += [self.d_path / "CTCA" / f"Diseased_{i}.nrrd" for i in diseased_idx]
+        paths = [str(p) for p in ctca_paths]
+        mtimes = [p.stat().st_mtime for p in ctca_paths]
+
+        cache = {}
+        if self._cache_path.exists():
+            with open(self._cache_path) as f:
+                cache = json.load(f)
+
+        cache_key = f"{self.split_strat}_{self.split}"
+        entry = cache.get(cache_key)
+
+        # The selected patients depend on np.random state, so a stale entry for a
+        # different selection must not pass on matching mtimes alone
+        if entry is not None and entry["paths"] == paths and entry["mtimes"] == mtimes:
+            return entry["num_slices"], list(normal_idx), list(diseased_idx)
+
+        # Header reads are I/O-bound and release the GIL, so fan them out
+        with ThreadPoolExecutor(max_workers=16) as ex:
+            num_slices = list(ex.map(lambda p: int(nrrd.read_header(str(p))["sizes"][-1]), ctca_paths))
+
+        cache[cache_key] = {"paths": paths, "num_slices": num_slices, "mtimes": mtimes}
 
-        for i in diseased_idx:
-            data, _ = nrrd.read(self.d_path / "CTCA" / f"Diseased_{i}.nrrd")
-            num_slices.append(data.shape[-1])
-            diseased_indices.append(i)
+        # Write-then-rename so concurrent writers (e.g. DDP ranks) can't corrupt the file
+        tmp_path = self._cache_path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(cache, f)
+        os.replace(tmp_path, self._cache_path)
 
-        return num_slices, healthy_indices, diseased_indices
\ No newline at end of file
+        return num_slices, list(normal_idx), list(diseased_idx)
\ No newline at end of file